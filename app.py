@@ -1,9 +1,23 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import NamedTuple
+import backoff
+import diskcache
+import hashlib
+import httpx
+import ijson
+from itertools import combinations
+import numpy as np
+import openai
+import orjson
 import streamlit as st
-from openai import OpenAI
-import networkx as nx
-from pyvis.network import Network
-import tempfile
+import tiktoken
+from aiolimiter import AsyncLimiter
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from graph_utils import VERDICT_PATTERN, canonicalize_books, parse_connections, render_graph_html, response_body_text
 import os
+import tempfile
 
 # --- DEFINITIVE PROXY FIX ---
 # Forcefully unset proxy environment variables at the very start of the script.
@@ -14,6 +28,49 @@ for proxy_var in ['http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY']:
     os.environ.pop(proxy_var, None)
 # --- END FIX ---
 
+MODEL = "gpt-5"
+EMBEDDING_MODEL = "text-embedding-3-small"
+WEB_SEARCH_TOOLS = [{"type": "web_search"}]
+# Reasoning efforts offered in the UI; the web search tool cannot be combined with "minimal".
+REASONING_EFFORTS = ["minimal", "medium"]
+# How long a model answer is reused before the same question is asked again.
+CACHE_TTL_SECONDS = 24 * 60 * 60
+# Answers kept in the in-memory layer of the answer cache; older ones are still on disk.
+MAX_MEMORY_ANSWERS = 10_000
+# Rendered map pages kept in memory; each is a full PyVis HTML page.
+MAX_CACHED_MAPS = 32
+# On-disk answer cache shared by every worker process and kept across restarts.
+ANSWER_CACHE_DIR = os.path.join(tempfile.gettempdir(), "openai_cache")
+
+# Upper bound on in-flight pair analyses; keeps the fan-out under the API rate limit.
+MAX_CONCURRENT_REQUESTS = 8
+# Attempts per request before a rate-limited or failing call is given up on.
+MAX_TRIES = 6
+# tiktoken may not know the newest model names; GPT-5 uses the o200k_base encoding.
+TOKEN_ENCODING = "o200k_base"
+# Token budget reserved for a reply before its real usage is known.
+RESPONSE_TOKEN_ALLOWANCE = 1000
+# Errors worth retrying: 429s, 5xx responses and dropped connections.
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+# Pooled connections held open to the API by the process-wide client.
+MAX_CONNECTIONS = 64
+# Pairs whose title embeddings are less similar than this skip the web-search call.
+SIMILARITY_THRESHOLD = 0.35
+# Lists whose titles all match a cached batched list this closely reuse its answer.
+SEMANTIC_MATCH_THRESHOLD = 0.95
+# Most recent batched book lists of each length remembered for semantic matching.
+SEMANTIC_INDEX_SIZE = 256
+# Disk cache key prefixes: a small per-length list of answer keys, and one embedding matrix per list.
+SEMANTIC_INDEX_KEY = "semantic-index"
+SEMANTIC_EMBEDDINGS_KEY = "semantic"
+# How often the script checks on a streaming batched request to report progress.
+PROGRESS_POLL_SECONDS = 0.5
+# Largest book list sent as one batched prompt; longer lists fall back to per-pair analysis.
+MAX_BATCHED_BOOKS = 20
+
+BATCHED_MODE = "Single batched request"
+PAIRWISE_MODE = "One request per pair"
+
 
 # --- Setup OpenAI client using Environment Variables ---
 api_key = os.environ.get("OPENAI_API_KEY")
@@ -25,18 +82,609 @@ if not api_key:
     )
     st.stop()
 
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    """Run one event loop per process in a daemon thread.
+
+    The cached client's pooled connections belong to the loop that opened them, so every request
+    goes through this long-lived loop instead of a fresh ``asyncio.run`` per rerun.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="openai-event-loop", daemon=True).start()
+    return loop
+
+
+def run_async(coro):
+    """Schedule ``coro`` on the shared event loop and return a ``concurrent.futures.Future``."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key):
+    """Build one client per process so its connection pool survives Streamlit reruns.
+
+    HTTP/2 lets the concurrent pair analyses share multiplexed connections instead of queueing for one each.
+    """
+    http_client = DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+    )
+    return AsyncOpenAI(api_key=api_key, http_client=http_client)
+
+
+class RateLimits:
+    """Request and token buckets for one rate setting, plus tokens owed by calls that overran."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = AsyncLimiter(requests_per_minute, 60)
+        self.tokens = AsyncLimiter(tokens_per_minute, 60)
+        # Only touched on the event loop thread, so these counters need no lock.
+        self.token_debt = 0
+        # Usage of pair calls read to the end, to charge the ones that stop early on a NO verdict.
+        self.pair_tokens = 0
+        self.pair_calls = 0
+
+    def record_pair_tokens(self, used):
+        self.pair_tokens += used
+        self.pair_calls += 1
+
+    def average_pair_tokens(self, default):
+        """Return the mean usage of finished pair calls, or ``default`` before any has finished."""
+        return self.pair_tokens // self.pair_calls if self.pair_calls else default
+
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limits(requests_per_minute, tokens_per_minute):
+    """Share one pair of limiters per setting across sessions, since the API limits apply to the whole key."""
+    return RateLimits(requests_per_minute, tokens_per_minute)
+
+
+@st.cache_resource(show_spinner=False)
+def get_token_encoding():
+    """Load the tokenizer once per process, or ``None`` if its BPE file cannot be downloaded."""
+    try:
+        return tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception:
+        return None
+
+
+def estimate_tokens(*texts):
+    """Estimate a call's token cost: its prompt texts plus a reply allowance.
+
+    Runs on the script thread, so loading the tokenizer never stalls the shared event loop. Without
+    a tokenizer, about four characters per token is close enough for pacing.
+    """
+    encoding = get_token_encoding()
+    if encoding is None:
+        prompt_tokens = sum(len(text) // 4 for text in texts)
+    else:
+        prompt_tokens = sum(len(encoding.encode(text)) for text in texts)
+    return prompt_tokens + RESPONSE_TOKEN_ALLOWANCE
+
+
+async def reserve_tokens(limits, estimate):
+    """Wait until the token bucket can cover ``estimate`` and any debt; return the tokens reserved for this call."""
+    # aiolimiter refuses a single acquire larger than the whole bucket.
+    estimate = min(estimate, limits.tokens.max_rate)
+    # Take over as much of the debt as fits, before awaiting, so concurrent calls never pay the same debt twice.
+    repaid = min(limits.token_debt, limits.tokens.max_rate - estimate)
+    limits.token_debt -= repaid
+    await limits.tokens.acquire(estimate + repaid)
+    return estimate
+
+
+def settle_tokens(limits, reserved, used):
+    """Record tokens a call used beyond its reservation as debt for the next reservations to pay.
+
+    The finished answer is returned right away instead of waiting for the bucket to refill. aiolimiter
+    cannot hand capacity back, so an overestimate simply drains off with time.
+    """
+    if used > reserved:
+        limits.token_debt += used - reserved
+
+
 # Now, initialize the client in the standard way. The proxy issue is already solved.
 try:
-    client = OpenAI(api_key=api_key)
+    client = get_openai_client(api_key)
 except Exception as e:
     st.error(f"Failed to initialize OpenAI client: {e}", icon="🚨")
     st.stop()
 
+# Model calls retry through backoff (with jitter across the whole fan-out) instead of the SDK's own retries.
+model_client = client.with_options(max_retries=0)
+
+
+class ModelSettings(NamedTuple):
+    """Per-run choices that change what the model is asked, and so which cached answers apply."""
+    effort: str
+    web_search: bool
+
+    def options(self):
+        return {
+            "model": MODEL,
+            "reasoning": {"effort": self.effort},
+            "tools": WEB_SEARCH_TOOLS if self.web_search else [],
+        }
+
+    def instructions(self, kind):
+        """Return the pair (``kind="pair"``) or batched (``kind="batch"``) instructions for these settings."""
+        template = PAIR_INSTRUCTIONS if kind == "pair" else BATCHED_INSTRUCTIONS
+        return template.format(**INSTRUCTION_SOURCES[self.web_search])
+
+    def request(self, kind):
+        """Return every request parameter except the input, for a pair or batched call."""
+        request = {**self.options(), "instructions": self.instructions(kind)}
+        if kind == "batch":
+            request["text"] = {"format": BATCHED_TEXT_FORMAT}
+        return request
+
+
+# --- Answer cache ---
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=MAX_MEMORY_ANSWERS, show_spinner=False)
+def cached_answer(settings, key, _answer=None):
+    """Store or look up a model answer, shared across reruns and sessions.
+
+    ``st.cache_data`` cannot memoize coroutines, so it is used as a TTL'd store: called without
+    ``_answer`` it raises ``LookupError`` on a miss (exceptions are never cached); called with
+    ``_answer`` it records that answer under ``(settings, key)``.
+    """
+    if _answer is None:
+        raise LookupError(key)
+    return _answer
+
+
+@st.cache_resource(show_spinner=False)
+def get_disk_cache():
+    return diskcache.Cache(ANSWER_CACHE_DIR)
+
+
+def answer_digest(settings, key):
+    """Hash the full request (model, effort, tools, instructions, output format) and question into a disk cache key.
+
+    The instructions and format are part of the key, so answers given under an earlier prompt are not
+    replayed after a deploy changes it.
+    """
+    payload = orjson.dumps({"request": settings.request(key[0]), "key": key}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+
+def lookup_answer(settings, key):
+    """Return a cached answer from memory or, failing that, from disk; ``None`` on a miss."""
+    try:
+        return cached_answer(settings, key)
+    except LookupError:
+        pass
+
+    answer = get_disk_cache().get(answer_digest(settings, key))
+    if answer is not None:
+        cached_answer(settings, key, _answer=answer)
+    return answer
+
+
+def store_answer(settings, key, answer):
+    get_disk_cache().set(answer_digest(settings, key), answer, expire=CACHE_TTL_SECONDS)
+    return cached_answer(settings, key, _answer=answer)
+
+
+# --- Pair analysis ---
+def pair_key(book1, book2):
+    # Order- and case-independent so (A, B), (B, A) and re-cased titles share one cache entry, as batched keys do.
+    return ("pair", *sorted((book1.casefold(), book2.casefold())))
+
+
+# Instructions are sent bit-identical ahead of every request's variable input, so repeated calls
+# share a common prefix the API can serve from its prompt cache.
+# ``ModelSettings.instructions`` fills in how the model is told to research the books.
+PAIR_INSTRUCTIONS = (
+    "{approach}, analyze and determine if there are significant conceptual connections (e.g., themes, author influence, subject matter) between the two books given. "
+    "Start your response with 'YES:' if they are related, or 'NO:' if they are not. "
+    "If YES, please provide a concise, one-sentence explanation of the connection{grounding}."
+)
+PAIR_PROMPT_TEMPLATE = "Book 1: '{book1}'\nBook 2: '{book2}'"
+
+BATCHED_INSTRUCTIONS = (
+    "{approach}, analyze and determine which of the given books have significant conceptual connections (e.g., themes, author influence, subject matter) with each other. "
+    "List every related pair once using the book numbers given as i and j, each with a concise, one-sentence explanation of the connection{grounding}."
+)
+# Wording for runs with and without the web search tool, so the model is never told to use a tool it lacks.
+INSTRUCTION_SOURCES = {
+    True: {"approach": "Using a web search", "grounding": " based on your findings"},
+    False: {"approach": "Drawing on your own knowledge of the books", "grounding": ""},
+}
+# Structured-output format for the batched answer; strict mode guarantees JSON of exactly this shape,
+# so the instructions no longer need to spell it out.
+BATCHED_TEXT_FORMAT = {
+    "type": "json_schema",
+    "name": "connections",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "connections": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "i": {"type": "integer"},
+                        "j": {"type": "integer"},
+                        "explanation": {"type": "string"},
+                    },
+                    "required": ["i", "j", "explanation"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["connections"],
+        "additionalProperties": False,
+    },
+}
+
+
+def pair_prompt(book1, book2):
+    return PAIR_PROMPT_TEMPLATE.format(book1=book1, book2=book2)
+
+
+def batched_prompt(books):
+    numbered_books = "\n".join(f"{i}) {book}" for i, book in enumerate(books, start=1))
+    return f"Books:\n{numbered_books}"
+
+
+@backoff.on_exception(backoff.expo, RETRYABLE_ERRORS, max_tries=MAX_TRIES, jitter=backoff.full_jitter)
+async def analyze_pair(book1, book2, settings, sem, limits, estimate):
+    """Ask the model whether two books are connected and return its raw answer.
+
+    The answer is streamed so a "NO" verdict can close the request as soon as it arrives;
+    only "YES" answers need the explanation that follows.
+    """
+    prompt = pair_prompt(book1, book2)
+    text = ""
+    usage = None
+    async with sem:
+        reserved = await reserve_tokens(limits, estimate)
+        async with limits.requests, model_client.responses.stream(**settings.request("pair"), input=prompt) as stream:
+            async for event in stream:
+                if event.type != "response.output_text.delta":
+                    continue
+                text += event.delta
+                verdict = VERDICT_PATTERN.match(text)
+                # Wait for a character past the verdict so a split token like "No" + "netheless" can't end the read.
+                if verdict and verdict.group(1).upper() == "NO" and verdict.end(1) < len(text):
+                    break
+            else:
+                # Only a stream read to the end reports usage.
+                usage = (await stream.get_final_response()).usage
+    if usage is None:
+        # A call closed early is still billed for its search and reasoning, so charge it what
+        # finished pair calls have used on average rather than only its reservation.
+        used = limits.average_pair_tokens(reserved)
+    else:
+        used = usage.total_tokens
+        limits.record_pair_tokens(used)
+    settle_tokens(limits, reserved, used)
+    return text.strip()
+
+
+def analyze_pairs(book_pairs, settings, limits, on_complete):
+    """Analyze every pair concurrently, calling ``on_complete(book1, book2)`` as each finishes.
+
+    Cached pairs are answered immediately and only misses are sent to the API. Results are returned
+    in the order of ``book_pairs``; failed calls come back as the raised exception.
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    results = {}
+    pending = {}
+
+    for book1, book2 in book_pairs:
+        cached = lookup_answer(settings, pair_key(book1, book2))
+        if cached is not None:
+            results[book1, book2] = cached
+            on_complete(book1, book2)
+        else:
+            estimate = estimate_tokens(settings.instructions("pair"), pair_prompt(book1, book2))
+            pending[run_async(analyze_pair(book1, book2, settings, sem, limits, estimate))] = (book1, book2)
+
+    # Futures resolve on the event loop thread; Streamlit calls stay on the script thread.
+    try:
+        for future in concurrent.futures.as_completed(pending):
+            book1, book2 = pending[future]
+            try:
+                results[book1, book2] = store_answer(settings, pair_key(book1, book2), future.result())
+            except Exception as e:
+                results[book1, book2] = e
+            on_complete(book1, book2)
+    finally:
+        # A rerun abandons this loop mid-way; stop the queued calls instead of paying for answers nobody stores.
+        for future in pending:
+            future.cancel()
+
+    return [results[pair] for pair in book_pairs]
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def embed_books(books):
+    """Embed the titles into one contiguous float32 matrix, a row per book."""
+    data = run_async(client.embeddings.create(model=EMBEDDING_MODEL, input=list(books))).result().data
+    M = np.empty((len(data), len(data[0].embedding)), dtype=np.float32)
+    for i, item in enumerate(data):
+        M[i] = item.embedding
+    return M
+
+
+def unit_rows(M):
+    return M / np.linalg.norm(M, axis=1, keepdims=True)
+
+
+def similar_pairs(books):
+    """Return the pairs whose title embeddings are similar enough to be worth a web-search call."""
+    M = unit_rows(embed_books(tuple(books)))
+    # One float32 GEMM gives every pairwise cosine similarity; the upper triangle holds each pair once.
+    sims = M @ M.T
+    return [(books[i], books[j]) for i, j in np.argwhere(np.triu(sims > SIMILARITY_THRESHOLD, k=1))]
+
+
+def select_book_pairs(books, use_prefilter):
+    """List the pairs to analyze, dropping unlikely ones when the embedding prefilter is on."""
+    book_pairs = list(combinations(books, 2))
+    if not use_prefilter:
+        return book_pairs
+
+    try:
+        candidates = similar_pairs(books)
+    except Exception as e:
+        st.warning(f"Embedding prefilter unavailable, analyzing every pair instead: {e}")
+        return book_pairs
+
+    if len(candidates) < len(book_pairs):
+        st.info(f"Embedding prefilter skipped {len(book_pairs) - len(candidates)} of {len(book_pairs)} unlikely pairs.")
+    return candidates
+
+
+def connections_from_answers(book_pairs, answers):
+    """Keep the pairs the model answered YES for, reporting the ones whose call failed."""
+    connections = []
+    for (book1, book2), answer in zip(book_pairs, answers):
+        if isinstance(answer, Exception):
+            st.error(f"An API error occurred while comparing '{book1}' and '{book2}': {answer}")
+            continue
+
+        verdict = VERDICT_PATTERN.match(answer)
+        if verdict and verdict.group(1).upper() == "YES":
+            connections.append((book1, book2, verdict.group(2).strip()))
+    return connections
+
+
+def semantic_lookup(books, settings):
+    """Find a cached batched answer for a list of near-identical titles.
+
+    Matches each title to its most similar title in every remembered list of the same length. On a
+    one-to-one match above ``SEMANTIC_MATCH_THRESHOLD``, returns the cached answer and the caller's
+    titles reordered to line up with that answer's numbering; otherwise ``None``.
+    """
+    cache = get_disk_cache()
+    keys = cache.get((SEMANTIC_INDEX_KEY, len(books)), [])
+    if not keys:
+        return None
+
+    query = unit_rows(embed_books(tuple(books)))
+    for key in keys:
+        # Loaded one list at a time; an expired list's embeddings are simply gone.
+        M = cache.get((SEMANTIC_EMBEDDINGS_KEY, key))
+        if M is None:
+            continue
+        # Rows are the remembered titles, columns the caller's.
+        sims = M @ query.T
+        match = sims.argmax(axis=1)
+        if len(set(match.tolist())) < len(books) or sims[np.arange(len(books)), match].min() < SEMANTIC_MATCH_THRESHOLD:
+            continue
+        text = lookup_answer(settings, key)
+        if text is not None:
+            return text, [books[k] for k in match]
+    return None
+
+
+def remember_semantic(key, books):
+    """Add a freshly answered book list to the semantic index, evicting the oldest lists of its length.
+
+    The embeddings expire together with the answer they point to, and the index holds only keys.
+    """
+    M = unit_rows(embed_books(tuple(books)))
+    cache = get_disk_cache()
+    cache.set((SEMANTIC_EMBEDDINGS_KEY, key), M, expire=CACHE_TTL_SECONDS)
+    index_key = (SEMANTIC_INDEX_KEY, len(books))
+    with cache.transact():
+        keys = [k for k in cache.get(index_key, []) if k != key and (SEMANTIC_EMBEDDINGS_KEY, k) in cache]
+        cache.set(index_key, (keys + [key])[-SEMANTIC_INDEX_SIZE:], expire=CACHE_TTL_SECONDS)
+
+
+def analyze_all_at_once(books, settings, limits, on_progress):
+    """Ask for every related pair in a single request.
+
+    ``on_progress(found)`` is called with the number of pairs parsed so far while the answer streams in.
+
+    Returns ``(book1, book2, explanation)`` tuples. Raises ``ValueError`` if the answer is not the
+    expected JSON, so the caller can fall back to per-pair analysis.
+    """
+    # Ask in a canonical order so reordered or re-cased lists share one cache entry; the answer's
+    # numbering then refers to that order and maps back onto the caller's own titles.
+    books = sorted(books, key=str.casefold)
+    key = ("batch", *(book.casefold() for book in books))
+    text = lookup_answer(settings, key)
+    if text is not None:
+        return parse_connections(books, text)
+
+    # The semantic cache only saves work; an embeddings failure must not block the real request.
+    try:
+        match = semantic_lookup(books, settings)
+    except Exception:
+        match = None
+    if match is not None:
+        text, aligned_books = match
+        return parse_connections(aligned_books, text)
+
+    found = []
+    estimate = estimate_tokens(settings.instructions("batch"), batched_prompt(books))
+    future = run_async(request_all_at_once(books, settings, limits, estimate, found))
+    try:
+        while True:
+            try:
+                text = future.result(timeout=PROGRESS_POLL_SECONDS)
+                break
+            except concurrent.futures.TimeoutError:
+                on_progress(len(found))
+    finally:
+        # Stop the request if a rerun abandons the wait; its answer would never be stored.
+        future.cancel()
+
+    # Parse before caching so a malformed answer is retried rather than replayed.
+    connections = parse_connections(books, text)
+    store_answer(settings, key, text)
+    try:
+        remember_semantic(key, books)
+    except Exception:
+        pass
+    return connections
+
+
+@backoff.on_exception(backoff.expo, RETRYABLE_ERRORS, max_tries=MAX_TRIES, jitter=backoff.full_jitter)
+async def request_all_at_once(books, settings, limits, estimate, found):
+    """Stream the numbered book list's answer and return the model's raw JSON text.
+
+    Connections are parsed incrementally as the text arrives and appended to ``found``, so the
+    script thread can report progress long before the model finishes.
+    """
+    found.clear()
+    text = ""
+    parsed = ijson.sendable_list()
+    parser = ijson.items_coro(parsed, "connections.item")
+
+    prompt = batched_prompt(books)
+    reserved = await reserve_tokens(limits, estimate)
+    async with limits.requests, model_client.responses.stream(**settings.request("batch"), input=prompt) as stream:
+        async for event in stream:
+            if event.type != "response.output_text.delta":
+                continue
+            text += event.delta
+            if parser is None:
+                continue
+            # Progress only: a malformed stream stops the incremental parse, and the full parse
+            # of the finished text decides what is kept.
+            try:
+                parser.send(event.delta.encode("utf-8"))
+            except ijson.JSONError:
+                parser = None
+            found.extend(parsed)
+            del parsed[:]
+        usage = (await stream.get_final_response()).usage
+    settle_tokens(limits, reserved, usage.total_tokens)
+    return text
+
+
+# --- Batch API ---
+# Batch jobs that can no longer produce results.
+BATCH_FAILED_STATUSES = {"failed", "expired", "cancelled"}
+# How often a pending batch job is polled while its page is open.
+BATCH_POLL_SECONDS = 30
+# Book lists this long always go through the Batch API; the synchronous path would take too many calls.
+BATCH_API_MIN_BOOKS = 100
+
+
+async def submit_batch(books, book_pairs, settings):
+    """Submit the pair prompts as one Batch API job and return its id."""
+    positions = {book: i for i, book in enumerate(books)}
+    lines = [
+        orjson.dumps({
+            "custom_id": f"{positions[book1]}-{positions[book2]}",
+            "method": "POST",
+            "url": "/v1/responses",
+            "body": {**settings.request("pair"), "input": pair_prompt(book1, book2)},
+        })
+        for book1, book2 in book_pairs
+    ]
+    batch_file = await client.files.create(file=("book_pairs.jsonl", b"\n".join(lines)), purpose="batch")
+    batch = await client.batches.create(input_file_id=batch_file.id, endpoint="/v1/responses", completion_window="24h")
+    return batch.id
+
+
+async def fetch_batch(batch_id):
+    """Return the batch job and, once it has completed, the raw bytes of its output file."""
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status != "completed" or not batch.output_file_id:
+        return batch, None
+    output = await client.files.content(batch.output_file_id)
+    return batch, output.content
+
+
+def batch_answers(books, book_pairs, settings, output):
+    """Match batch output lines back to ``book_pairs``, caching every successful answer."""
+    answers_by_id = {}
+    # orjson parses each JSONL line straight from bytes, without decoding the whole file first.
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            answers_by_id[record["custom_id"]] = RuntimeError(record.get("error") or response.get("body"))
+        else:
+            answers_by_id[record["custom_id"]] = response_body_text(response["body"])
+
+    positions = {book: i for i, book in enumerate(books)}
+    answers = []
+    for book1, book2 in book_pairs:
+        answer = answers_by_id.get(f"{positions[book1]}-{positions[book2]}", RuntimeError("No result returned by the batch job."))
+        if not isinstance(answer, Exception):
+            store_answer(settings, pair_key(book1, book2), answer)
+        answers.append(answer)
+    return answers
+
+
+# --- Graph rendering ---
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=MAX_CACHED_MAPS, show_spinner=False)
+def cached_graph_html(books, connections):
+    """Render the map once per distinct graph, shared across reruns and sessions."""
+    return render_graph_html(books, connections)
+
+
+def build_knowledge_map(books, map_request, connections):
+    """Build the graph and its HTML once and keep both in session state, so reruns skip all LLM work."""
+    # One edge per unordered pair; the batched answer may name a pair twice.
+    edges = {frozenset((book1, book2)): (book1, book2, explanation) for book1, book2, explanation in connections}
+
+    st.session_state["knowledge_graph"] = list(edges.values())
+    st.session_state["knowledge_graph_books"] = books
+    st.session_state["knowledge_graph_request"] = map_request
+    st.session_state["pyvis_html"] = cached_graph_html(tuple(books), tuple(edges.values())) if edges else None
+
+
+def show_knowledge_map():
+    """Display the map kept in session state by ``build_knowledge_map``."""
+    if not st.session_state["knowledge_graph"]:
+        st.warning("No significant connections were found among the entered books.")
+    else:
+        st.components.v1.html(st.session_state["pyvis_html"], height=720, scrolling=True)
+
 
 # --- Streamlit UI ---
 st.set_page_config(page_title="Book Knowledge Mapper", layout="wide")
-st.title("📚 Book Knowledge Mapper (with Web Search)")
-st.markdown("Discover conceptual connections between books using an AI agent that can search the web for deeper insights. Enter a list of books below.")
+st.title("📚 Book Knowledge Mapper")
+st.markdown("Discover conceptual connections between books using an AI model, optionally backed by a web search for deeper insights. Enter a list of books below.")
+
+requests_per_minute = st.sidebar.slider(
+    "Requests per minute",
+    min_value=10,
+    max_value=1000,
+    value=100,
+    step=10,
+    help="Upper bound on model requests sent to OpenAI per minute. Set it just below your account's rate limit.",
+)
+tokens_per_minute = st.sidebar.number_input(
+    "Tokens per minute",
+    min_value=10_000,
+    value=500_000,
+    step=10_000,
+    help="Upper bound on model tokens used per minute. Requests wait for budget up front, so they stay under your account's token limit instead of running into 429s.",
+)
 
 # --- User input: list of books ---
 st.markdown("##### Enter a list of books (one per line):")
@@ -46,82 +694,205 @@ books_input = st.text_area(
     label_visibility="collapsed",
     value="Sapiens: A Brief History of Humankind by Yuval Noah Harari\nThe Selfish Gene by Richard Dawkins\nThinking, Fast and Slow by Daniel Kahneman\nSuperintelligence by Nick Bostrom\nFahrenheit 451 by Ray Bradbury"
 )
-books = [b.strip() for b in books_input.split("\n") if b.strip()]
+books = list(canonicalize_books(books_input))
+duplicates = sum(1 for b in books_input.split("\n") if b.strip()) - len(books)
 
 if books:
-    st.success(f"{len(books)} books entered.")
+    st.success(f"{len(books)} books entered." + (f" {duplicates} duplicate titles ignored." if duplicates else ""))
+
+analysis_mode = st.radio(
+    "Analysis mode",
+    [BATCHED_MODE, PAIRWISE_MODE],
+    horizontal=True,
+    help=f"A batched request analyzes up to {MAX_BATCHED_BOOKS} books in one API call; per-pair analysis issues one call for every pair of books.",
+)
+
+reasoning_effort = st.radio(
+    "Reasoning effort",
+    REASONING_EFFORTS,
+    index=REASONING_EFFORTS.index("medium"),
+    format_func=lambda effort: "Fast (minimal)" if effort == "minimal" else "Deep (medium)",
+    horizontal=True,
+    help="Minimal reasoning answers several times faster and spends far fewer hidden reasoning tokens, at the cost of shallower connections.",
+)
+
+use_web_search = st.checkbox(
+    "Search the web",
+    value=True,
+    disabled=reasoning_effort == "minimal",
+    help="Lets the model look up each book before answering. Slower, but finds less obvious connections. Not available with minimal reasoning.",
+)
+settings = ModelSettings(reasoning_effort, use_web_search and reasoning_effort != "minimal")
+
+use_batch_api = st.checkbox(
+    "Use Batch API (slower, cheaper)",
+    help=f"Submits every pair as an OpenAI Batch API job at about half the cost. Results can take up to 24 hours; keep this tab open and the map appears once the job completes. Always used for {BATCH_API_MIN_BOOKS} or more books.",
+)
+
+use_prefilter = st.checkbox(
+    "Skip unlikely pairs",
+    help="Compares cheap title embeddings first and only runs the full analysis for pairs whose titles look related. Cheaper, but can miss non-obvious connections between books on different topics. Does not apply to the single batched request.",
+)
+
+force_regenerate = st.checkbox(
+    "Force regenerate",
+    help="Rebuild the map even if one was already generated for this book list and these options.",
+)
+# Every choice that shapes the map; changing any of them rebuilds it instead of showing the old one.
+map_request = (settings, analysis_mode, use_batch_api, use_prefilter)
+
+
+# --- Pending Batch API job ---
+# A fragment polls the job on its own timer, so checking on it never reruns the rest of the page.
+@st.fragment(run_every=BATCH_POLL_SECONDS)
+def show_batch_status():
+    batch_job = st.session_state["batch_job"]
+    try:
+        batch, output = run_async(fetch_batch(batch_job["id"])).result()
+    except Exception as e:
+        st.error(f"Failed to check on batch job {batch_job['id']}: {e}")
+        return
+
+    if output is not None:
+        answers = batch_job["cached_answers"] + batch_answers(
+            batch_job["books"], batch_job["pairs"], batch_job["settings"], output
+        )
+        build_knowledge_map(
+            batch_job["books"],
+            batch_job["map_request"],
+            connections_from_answers(batch_job["cached_pairs"] + batch_job["pairs"], answers),
+        )
+        failed = sum(isinstance(answer, Exception) for answer in answers)
+        notice = f"Batch job {batch.id} completed" + (f"; {failed} pairs could not be analyzed." if failed else ".")
+        st.session_state["batch_notice"] = ("success", notice)
+    elif batch.status in BATCH_FAILED_STATUSES:
+        st.session_state["batch_notice"] = ("error", f"Batch job {batch.id} ended with status '{batch.status}'.")
+    else:
+        counts = batch.request_counts
+        done = f" ({counts.completed}/{counts.total} requests done)" if counts else ""
+        st.info(f"Batch job {batch.id} is {batch.status}{done}. Results will appear here once it completes.")
+        check_column, cancel_column = st.columns(2)
+        check_column.button("Check batch status")
+        if not cancel_column.button("Cancel batch job"):
+            return
+        try:
+            run_async(client.batches.cancel(batch.id)).result()
+        except Exception as e:
+            st.error(f"Failed to cancel batch job {batch.id}: {e}")
+            return
+        st.session_state["batch_notice"] = ("info", f"Cancelled batch job {batch.id}.")
+
+    # The job is finished or cancelled; rerun the whole page so the map or the notice replaces the status.
+    del st.session_state["batch_job"]
+    st.rerun()
+
+
+if "batch_notice" in st.session_state:
+    kind, notice = st.session_state.pop("batch_notice")
+    getattr(st, kind)(notice)
+
+if "batch_job" in st.session_state:
+    show_batch_status()
 
 # --- Generate connections ---
-if st.button("Generate Knowledge Map", type="primary") and books:
+# A second job would replace the pending one in session state, leaving it billed but never collected.
+if st.button(
+    "Generate Knowledge Map",
+    type="primary",
+    disabled="batch_job" in st.session_state,
+    help="Wait for the pending batch job to finish, or cancel it, before generating another map." if "batch_job" in st.session_state else None,
+) and books:
     if len(books) < 2:
         st.warning("Please enter at least two books to map connections.")
+    elif (
+        not force_regenerate
+        and st.session_state.get("knowledge_graph_books") == books
+        and st.session_state.get("knowledge_graph_request") == map_request
+    ):
+        st.success("Showing the map already generated for this book list and these options.")
+    elif use_batch_api or len(books) >= BATCH_API_MIN_BOOKS:
+        book_pairs = select_book_pairs(books, use_prefilter)
+        # Only pairs without a cached answer are worth submitting.
+        cached = {pair: lookup_answer(settings, pair_key(*pair)) for pair in book_pairs}
+        cached_pairs = [pair for pair, answer in cached.items() if answer is not None]
+        cached_answers = [cached[pair] for pair in cached_pairs]
+        pending_pairs = [pair for pair, answer in cached.items() if answer is None]
+
+        if not pending_pairs:
+            build_knowledge_map(books, map_request, connections_from_answers(cached_pairs, cached_answers))
+        else:
+            try:
+                batch_id = run_async(submit_batch(books, pending_pairs, settings)).result()
+            except Exception as e:
+                st.error(f"Failed to submit the batch job: {e}")
+            else:
+                for key in ("knowledge_graph", "knowledge_graph_books", "knowledge_graph_request", "pyvis_html"):
+                    st.session_state.pop(key, None)
+                st.session_state["batch_job"] = {
+                    "id": batch_id,
+                    "books": books,
+                    "pairs": pending_pairs,
+                    "settings": settings,
+                    "map_request": map_request,
+                    "cached_pairs": cached_pairs,
+                    "cached_answers": cached_answers,
+                }
+                # The prefilter's own notice is lost on the rerun below, so repeat it here.
+                skipped = len(books) * (len(books) - 1) // 2 - len(book_pairs)
+                st.session_state["batch_notice"] = (
+                    "success",
+                    ("" if use_batch_api else f"{BATCH_API_MIN_BOOKS} or more books entered, so the Batch API was used. ")
+                    + f"Submitted batch job {batch_id} for {len(pending_pairs)} pairs"
+                    + (f" ({skipped} unlikely pairs skipped by the embedding prefilter)" if skipped else "")
+                    + ". Results will appear here once it completes.",
+                )
+                # Rerun so the polling fragment starts right away.
+                st.rerun()
     else:
         progress_bar = st.progress(0, text="Initializing analysis...")
         status_text = st.empty()
-        
+
         with st.spinner("Building knowledge graph... This may take a moment."):
-            G = nx.Graph()
-            for book in books:
-                G.add_node(book, label=book, title=book)
-
-            book_pairs = [(books[i], books[j]) for i in range(len(books)) for j in range(i + 1, len(books))]
-            total_pairs = len(book_pairs)
-
-            for i, (book1, book2) in enumerate(book_pairs):
-                status_text.text(f"Analyzing connection {i+1}/{total_pairs}: '{book1}' and '{book2}'")
-                
-                prompt = (
-                    f"Using a web search, analyze and determine if there are significant conceptual connections (e.g., themes, author influence, subject matter) between the following two books: "
-                    f"Book 1: '{book1}' and Book 2: '{book2}'.\n\n"
-                    "Start your response with 'YES:' if they are related, or 'NO:' if they are not. "
-                    "If YES, please provide a concise, one-sentence explanation of the connection based on your findings."
-                )
+            use_batched = analysis_mode == BATCHED_MODE and len(books) <= MAX_BATCHED_BOOKS
+            if analysis_mode == BATCHED_MODE and not use_batched:
+                st.info(f"More than {MAX_BATCHED_BOOKS} books entered; analyzing each pair separately instead.")
 
+            connections = None
+            if use_batched:
+                status_text.text(f"Analyzing all {len(books) * (len(books) - 1) // 2} possible connections in a single request...")
                 try:
-                    response = client.responses.create(
-                        model="gpt-5",
-                        tools=[{"type": "web_search"}],
-                        input=prompt,
+                    connections = analyze_all_at_once(
+                        books,
+                        settings,
+                        get_rate_limits(requests_per_minute, tokens_per_minute),
+                        lambda found: status_text.text(f"Analyzing the book list in a single request... {found} connections found so far"),
                     )
-                    text = response.output_text.strip()
-
+                except ValueError as e:
+                    st.warning(f"The batched answer could not be parsed ({e}); analyzing each pair separately instead.")
                 except Exception as e:
-                    st.error(f"An API error occurred while comparing '{book1}' and '{book2}': {e}")
-                    continue
+                    st.error(f"An error occurred while analyzing the book list: {e}")
+                    connections = []
+                else:
+                    progress_bar.progress(1.0, text="Analysis complete")
 
-                if text.lower().startswith("yes"):
-                    explanation = text[4:].strip()
-                    G.add_edge(book1, book2, title=explanation, color="#3a78d1")
-                
-                progress_bar.progress((i + 1) / total_pairs, text=f"Analysis {i+1}/{total_pairs} complete")
+            if connections is None:
+                book_pairs = select_book_pairs(books, use_prefilter)
+                total_pairs = len(book_pairs)
+                completed = []
 
-            status_text.success("Analysis complete! Rendering visualization...")
+                def on_complete(book1, book2):
+                    completed.append((book1, book2))
+                    done = len(completed)
+                    status_text.text(f"Analyzed connection {done}/{total_pairs}: '{book1}' and '{book2}'")
+                    progress_bar.progress(done / total_pairs, text=f"Analysis {done}/{total_pairs} complete")
 
-            if not G.edges:
-                st.warning("No significant connections were found among the entered books.")
-            else:
-                net = Network(height="700px", width="100%", notebook=False, cdn_resources='in_line', bgcolor="#f0f2f6", font_color="black")
-                net.from_nx(G)
-                
-                net.set_options("""
-                var options = {
-                  "nodes": {"shape": "dot", "size": 20, "font": {"size": 14}},
-                  "edges": {"width": 2, "smooth": {"type": "continuous"}},
-                  "physics": {
-                    "forceAtlas2Based": {"gravitationalConstant": -50, "centralGravity": 0.01, "springLength": 200, "springConstant": 0.08},
-                    "maxVelocity": 50, "minVelocity": 0.1, "solver": "forceAtlas2Based", "timestep": 0.5,
-                    "stabilization": {"iterations": 150}
-                  }
-                }
-                """)
+                results = analyze_pairs(book_pairs, settings, get_rate_limits(requests_per_minute, tokens_per_minute), on_complete)
+                connections = connections_from_answers(book_pairs, results)
 
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".html") as tmp_file:
-                    net.save_graph(tmp_file.name)
-                    with open(tmp_file.name, 'r', encoding='utf-8') as f:
-                        html_content = f.read()
-                
-                st.components.v1.html(html_content, height=720, scrolling=True)
-                os.unlink(tmp_file.name)
+            status_text.success("Analysis complete! Rendering visualization...")
+            build_knowledge_map(books, map_request, connections)
 
-else:
+if "knowledge_graph" in st.session_state:
+    show_knowledge_map()
+elif "batch_job" not in st.session_state:
     st.info("Enter some books and click 'Generate Knowledge Map' to see the connections.")
@@ -0,0 +1,100 @@
+"""Streamlit-free helpers for the book knowledge map: input cleanup, answer parsing and graph rendering."""
+import functools
+import re
+
+from pydantic import BaseModel
+
+# Half-width, in vis.js canvas pixels, of the precomputed node layout.
+LAYOUT_SCALE = 500
+
+# Leading "YES"/"NO" verdict and the explanation that follows, tolerating markdown emphasis and
+# punctuation such as "**Yes** - ...", "Yes, both ..." or "NO." around the verdict.
+VERDICT_PATTERN = re.compile(r"^[\s*_]*(YES|NO)\b[\s*_:;,.\-\u2013\u2014]*(.*)", re.IGNORECASE | re.DOTALL)
+
+
+@functools.lru_cache(maxsize=64)
+def canonicalize_books(text):
+    """Return the non-blank lines of ``text`` with runs of whitespace collapsed and duplicates removed.
+
+    Titles that differ only in case count as duplicates; the first spelling entered is kept. The result
+    is a tuple because cached calls share it.
+    """
+    books = {}
+    for line in text.split("\n"):
+        book = " ".join(line.split())
+        if book:
+            books.setdefault(book.casefold(), book)
+    return tuple(books.values())
+
+
+class Connection(BaseModel):
+    i: int
+    j: int
+    explanation: str = ""
+
+
+class Connections(BaseModel):
+    connections: list[Connection] = []
+
+
+def parse_connections(books, text):
+    """Map the numbered pairs of a batched answer back to titles; misnumbered pairs are dropped.
+
+    Raises ``pydantic.ValidationError`` (a ``ValueError``) when the answer is not shaped like ``Connections``.
+    """
+    # pydantic parses and validates the raw JSON in one pass, without building intermediate dicts.
+    data = Connections.model_validate_json(text)
+
+    connections = []
+    for pair in data.connections:
+        if pair.i == pair.j or not (1 <= pair.i <= len(books) and 1 <= pair.j <= len(books)):
+            continue
+        connections.append((books[pair.i - 1], books[pair.j - 1], pair.explanation.strip()))
+    return connections
+
+
+def response_body_text(body):
+    """Concatenate the output text of a raw Responses API body."""
+    return "".join(
+        part.get("text", "")
+        for item in body.get("output", [])
+        if item.get("type") == "message"
+        for part in item.get("content", [])
+        if part.get("type") == "output_text"
+    ).strip()
+
+
+def render_graph_html(books, connections):
+    # networkx and PyVis are imported on first use, so pages that never draw a map don't load them.
+    import networkx as nx
+    from pyvis.network import Network
+
+    # Lay the graph out here rather than letting vis.js run its physics simulation in the browser:
+    # nodes arrive at their final positions and the page paints without a stabilization phase.
+    layout = nx.Graph()
+    layout.add_nodes_from(books)
+    layout.add_edges_from((book1, book2) for book1, book2, _ in connections)
+    positions = nx.spring_layout(layout, seed=0, scale=LAYOUT_SCALE)
+
+    # Reference vis.js from its CDN instead of inlining the library into every rendered page.
+    net = Network(height="700px", width="100%", notebook=False, cdn_resources='remote', bgcolor="#f0f2f6", font_color="black")
+    for book in books:
+        x, y = positions[book]
+        net.add_node(book, label=book, title=book, x=float(x), y=float(y), physics=False)
+    # Connections are already unique pairs, so their edge dicts go into the network in one pass rather
+    # than through add_edge, which rescans every existing edge for a duplicate on each call.
+    net.edges.extend(
+        {"from": book1, "to": book2, "title": explanation, "color": "#3a78d1"} for book1, book2, explanation in connections
+    )
+
+    # Straight edges, and hiding the graph while it is dragged, keep redraws cheap on larger maps.
+    net.set_options("""
+    var options = {
+      "nodes": {"shape": "dot", "size": 20, "font": {"size": 14}},
+      "edges": {"width": 2, "smooth": false},
+      "interaction": {"hideEdgesOnDrag": true, "hideNodesOnDrag": true},
+      "physics": {"enabled": false, "stabilization": {"enabled": false}}
+    }
+    """)
+
+    return net.generate_html(notebook=False)
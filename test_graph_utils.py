@@ -0,0 +1,66 @@
+import pytest
+
+from graph_utils import VERDICT_PATTERN, canonicalize_books, parse_connections, response_body_text
+
+
+@pytest.mark.parametrize(
+    "answer, verdict, explanation",
+    [
+        ("**Yes** - x", "Yes", "x"),
+        ("Yes, both books explore memory.", "Yes", "both books explore memory."),
+        ("YES; shared themes", "YES", "shared themes"),
+        ("NO.", "NO", ""),
+        ("No", "No", ""),
+    ],
+)
+def test_verdict_pattern_splits_verdict_from_explanation(answer, verdict, explanation):
+    match = VERDICT_PATTERN.match(answer)
+    assert match is not None
+    assert match.group(1) == verdict
+    assert match.group(2) == explanation
+
+
+def test_verdict_pattern_needs_a_whole_word():
+    assert VERDICT_PATTERN.match("Nonetheless, they differ.") is None
+
+
+def test_canonicalize_books_folds_case_and_whitespace():
+    text = "  Dune \n\nThe  Selfish Gene\nDUNE\nthe selfish\tgene\nNeuromancer"
+    assert canonicalize_books(text) == ("Dune", "The Selfish Gene", "Neuromancer")
+
+
+def test_parse_connections_maps_numbers_to_titles():
+    books = ["A", "B", "C"]
+    text = (
+        '{"connections": ['
+        '{"i": 1, "j": 3, "explanation": " shared author "},'
+        '{"i": 2, "j": 2, "explanation": "self pair"},'
+        '{"i": 0, "j": 1, "explanation": "out of range"},'
+        '{"i": 3, "j": 4, "explanation": "out of range"}'
+        "]}"
+    )
+    assert parse_connections(books, text) == [("A", "C", "shared author")]
+
+
+@pytest.mark.parametrize("text", ['{"connections": {}}', "[1, 2]", '{"connections": [{"i": "x", "j": 2}]}', "not json"])
+def test_parse_connections_rejects_wrong_shape(text):
+    with pytest.raises(ValueError):
+        parse_connections(["A", "B"], text)
+
+
+def test_response_body_text_joins_output_text_of_messages():
+    body = {
+        "output": [
+            {"type": "web_search_call", "status": "completed"},
+            {
+                "type": "message",
+                "content": [
+                    {"type": "output_text", "text": " YES: "},
+                    {"type": "refusal", "refusal": "ignored"},
+                    {"type": "output_text", "text": "both are about evolution. "},
+                ],
+            },
+        ]
+    }
+    assert response_body_text(body) == "YES: both are about evolution."
+    assert response_body_text({}) == ""